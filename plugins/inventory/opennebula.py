@@ -1,6 +1,11 @@
+import base64
 import collections
+import json
 import logging
+import xmlrpc.client
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from ansible.errors import AnsibleError, AnsibleOptionsError, AnsibleRuntimeError
@@ -22,6 +27,9 @@ short_description: OpenNebula inventory plugin
 author: Kaloyan Kotlarski
 description:
   - Retrieves inventory hosts from OpenNebula deployments
+requirements:
+  - pyone (parses the OpenNebula XML responses with lxml)
+  - requests
 options:
   one_url:
     type: string
@@ -51,6 +59,29 @@ options:
       - fqdn
       - name
     default: fqdn
+  one_concurrency:
+    type: integer
+    description:
+      - Maximum number of concurrent XML-RPC calls used to resolve VM templates and virtual networks
+        one by one, when the user isn't allowed to list the template or virtual network pools
+      - Also sets the size of the keep-alive connection pool to the OpenNebula endpoint
+    required: False
+    default: 20
+  one_skip_unused_facts:
+    type: boolean
+    description:
+      - Only gather the C(template) and C(user_attributes) facts when they are referenced by C(compose),
+        C(groups) or C(keyed_groups), which saves resolving templates and converting user templates
+      - When enabled these facts are also missing from the host variables of hosts that don't use them
+    required: False
+    default: False
+  one_cache_compress:
+    type: boolean
+    description:
+      - Store the inventory cache as zlib compressed JSON, which greatly reduces its size for large pools
+      - Compressed and uncompressed caches can both be read regardless of this setting
+    required: False
+    default: False
 extends_documentation_fragment:
   - inventory_cache
   - constructed   
@@ -63,6 +94,7 @@ HAS_PYONE_MODULE = False
 
 try:
     import pyone
+    import requests
 
     HAS_PYONE_MODULE = True
 except ImportError:
@@ -83,94 +115,269 @@ class State(Enum):
     cloning_failure = 11
 
 
+STATE_NAMES = {state.value: state.name for state in State}
+LCM_STATE_NAMES = {state.value: state.name.lower() for state in pyone.LCM_STATE} if HAS_PYONE_MODULE else {}
+
+
 def one_dict_to_lowercase(one_dict):
+    # str.lower() already takes CPython's ASCII fast path for OpenNebula's attribute names,
+    # a str.translate() table is several times slower
     result = {}
+    stack = [(result, one_dict)]
 
-    for key in one_dict.keys():
-        if key == "#text":
-            continue
+    while stack:
+        destination, source = stack.pop()
 
-        value = one_dict[key]
+        for key, value in source.items():
+            if key == "#text":
+                continue
 
-        if type(value) == str and len(one_dict[key]):
-            result[key.lower()] = to_text(one_dict[key])
-        elif type(value) == dict:
-            one_dict_to_lowercase(value)
+            if isinstance(value, str):
+                if value:
+                    destination[key.lower()] = value
+            elif isinstance(value, dict):
+                nested = {}
+                destination[key.lower()] = nested
+                stack.append((nested, value))
 
     return result
 
 
-def get_domain_name_for_network(server, network_id):
-    vm_virtual_network = server.vn.info(int(network_id))
+def get_vm_nics(vm_template):
+    if "NIC" not in vm_template:
+        return []
+
+    if isinstance(vm_template["NIC"], dict):
+        return [vm_template["NIC"]]
+    elif isinstance(vm_template["NIC"], list):
+        return vm_template["NIC"]
+
+    return []
+
+
+class VMRecord(collections.namedtuple("VMRecord", [
+        "id", "name", "state", "lcm_state", "deploy_id", "start_timestamp", "nic", "network_id_domain_map",
+        "template_id", "template", "user_attributes"], defaults=(None, None, None))):
+    """Facts of a single VM, stored as a plain row in the inventory cache"""
+
+    __slots__ = ()
+
+    def as_dict(self):
+        return {field: value for field, value in zip(self._fields, self) if value is not None}
+
+
+def compress_cache_data(data):
+    blob = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+    return {"v": 1, "blob": base64.b64encode(blob).decode("ascii")}
+
+
+def decompress_cache_data(payload):
+    return json.loads(zlib.decompress(base64.b64decode(payload["blob"])).decode("utf-8"))
+
 
-    if "DOMAIN" in vm_virtual_network.TEMPLATE:
-        return vm_virtual_network.TEMPLATE["DOMAIN"][:-1]
-    else:
-        return None
+class SessionTransport(xmlrpc.client.Transport):
+    """XML-RPC transport reusing keep-alive connections from a pooled requests session"""
+
+    def __init__(self, use_https=False, https_verify=True, pool_size=10):
+        super(SessionTransport, self).__init__()
+
+        self.use_https = use_https
+        self.https_verify = https_verify
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, host, handler, request_body, verbose=False):
+        scheme = "https" if self.use_https else "http"
+        url = f"{scheme}://{host}/{handler.lstrip('/')}"
+
+        response = self.session.post(url, data=request_body, headers={"Content-Type": "text/xml"},
+                                     verify=self.https_verify)
+        try:
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise xmlrpc.client.ProtocolError(url, response.status_code, str(e), response.headers)
+
+        parser, unmarshaller = self.getparser()
+        parser.feed(response.content)
+        parser.close()
+
+        return unmarshaller.close()
+
+    def close(self):
+        self.session.close()
 
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     """Host Inventory provider for ansible using OpenNebula"""
 
     NAME = "netcho.opennebula.opennebula"
+    _VALID_SUFFIXES = ("one.yaml", "one.yml")
 
-    def _get_vmpool(self):
+    def _get_vmpool_page(self, offset, page_size):
+        # a negative range end makes OpenNebula treat the range start as an offset and the end as the page size
         try:
-            return self.server.vmpool.infoextended(-2, -1, -1, -1)
+            return self.server.vmpool.infoextended(-2, offset, -page_size, -1).VM
         except pyone.OneException as e:
-            raise AnsibleRuntimeError(e.message)
-
-    def _get_dict_for_vm(self, vm):
-        vm_state = State(vm.get_STATE())
-        vm_lcm_state = pyone.LCM_STATE(vm.get_LCM_STATE())
-
-        vm_dict = {
-            "id": vm.get_ID(),
-            "name": vm.get_NAME(),
-            "state": vm_state.name,
-            "lcm_state": str(vm_lcm_state.name).lower(),
-            "deploy_id": vm.get_DEPLOY_ID(),
-            "start_timestamp": vm.get_STIME(),
-            "nic": [],
-            "network_id_domain_map": {}
-        }
-
-        vm_template = vm.get_TEMPLATE()
+            raise AnsibleRuntimeError(str(e))
+
+    def _iter_vmpool(self, page_size=500):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            offset = 0
+            next_page = executor.submit(self._get_vmpool_page, offset, page_size)
+
+            while next_page is not None:
+                page = next_page.result()
+                offset += page_size
+
+                # fetch the following page while the current one is being processed
+                if len(page) == page_size:
+                    next_page = executor.submit(self._get_vmpool_page, offset, page_size)
+                else:
+                    next_page = None
+
+                if page:
+                    yield page
+
+    def _get_template_names(self):
+        try:
+            return {template.ID: template.NAME for template in self.server.templatepool.info(-2, -1, -1).VMTEMPLATE}
+        except pyone.OneAuthorizationException:
+            display.vvv("Not authorized to list the template pool, retrieving templates one by one")
+            return None
+        except pyone.OneException as e:
+            raise AnsibleRuntimeError(str(e))
+
+    def _get_template_name(self, template_id):
+        try:
+            return self.server.template.info(template_id).NAME
+        except pyone.OneNoExistsException:
+            return None
+        except pyone.OneException as e:
+            raise AnsibleRuntimeError(str(e))
+
+    def _get_vn_domains(self):
+        try:
+            return {vn.ID: vn.TEMPLATE["DOMAIN"][:-1] if "DOMAIN" in vn.TEMPLATE else None
+                    for vn in self.server.vnpool.info(-2, -1, -1).VNET}
+        except pyone.OneAuthorizationException:
+            display.vvv("Not authorized to list the virtual network pool, retrieving virtual networks one by one")
+            return None
+        except pyone.OneException as e:
+            raise AnsibleRuntimeError(str(e))
+
+    def _get_vn_domain(self, network_id):
+        try:
+            vm_virtual_network = self.server.vn.info(network_id)
+        except pyone.OneNoExistsException:
+            return None
+        except pyone.OneException as e:
+            raise AnsibleRuntimeError(str(e))
+
+        if "DOMAIN" in vm_virtual_network.TEMPLATE:
+            return vm_virtual_network.TEMPLATE["DOMAIN"][:-1]
+        else:
+            return None
+
+    def _map_concurrently(self, func, ids):
+        # the transport only holds a thread-safe connection pool, so the server proxy can be shared between workers
+        with ThreadPoolExecutor(max_workers=self.get_option("one_concurrency")) as executor:
+            return dict(zip(ids, executor.map(func, ids)))
+
+    def _get_template(self, template_id):
+        if template_id not in self._template_names:
+            self._template_names[template_id] = self._get_template_name(template_id)
+
+        return self._template_names[template_id]
+
+    def _get_domain(self, network_id):
+        network_id = int(network_id)
+        if network_id not in self._vn_domains:
+            self._vn_domains[network_id] = self._get_vn_domain(network_id)
+
+        return self._vn_domains[network_id]
+
+    def _get_record_for_vm(self, vm):
+        nics = []
+        network_id_domain_map = {}
+        template_id = None
+        template = None
+        user_attributes = None
+
+        vm_template = vm.TEMPLATE
         if vm_template is not None:
             if "TEMPLATE_ID" in vm_template:
-                vm_dict["template_id"] = int(vm_template["TEMPLATE_ID"])
-                try:
-                    template_info = self.server.template.info(vm_dict["template_id"])
-                    vm_dict["template"] = template_info.get_NAME()
-                except pyone.OneNoExistsException:
-                    display.vvv(f"VM {vm.get_NAME()} template ID {vm_template['TEMPLATE_ID']} doesn't not exist, not retrieving it")
-                    pass
-                except pyone.OneException as e:
-                    raise AnsibleRuntimeError(str(e))
+                template_id = int(vm_template["TEMPLATE_ID"])
+                if self._need_template:
+                    template = self._get_template(template_id)
+                    if template is None:
+                        display.vvv(f"VM {vm.NAME} template ID {vm_template['TEMPLATE_ID']} doesn't not exist, not retrieving it")
+
+            for nic in get_vm_nics(vm_template):
+                nics.append(one_dict_to_lowercase(nic))
+
+                network_domain_name = self._get_domain(nic["NETWORK_ID"])
+
+                if network_domain_name is not None:
+                    network_id_domain_map[nic["NETWORK_ID"]] = network_domain_name
+
+        if self._need_user_attributes and hasattr(vm, "USER_TEMPLATE"):
+            user_attributes = one_dict_to_lowercase(vm.USER_TEMPLATE)
+
+        return VMRecord(
+            id=vm.ID,
+            name=vm.NAME,
+            state=STATE_NAMES[vm.STATE],
+            lcm_state=LCM_STATE_NAMES[vm.LCM_STATE],
+            deploy_id=vm.DEPLOY_ID,
+            start_timestamp=vm.STIME,
+            nic=nics,
+            network_id_domain_map=network_id_domain_map,
+            template_id=template_id,
+            template=template,
+            user_attributes=user_attributes
+        )
 
-            if "NIC" in vm_template:
-                vm_nics = []
+    def _query(self):
+        vm_rows = []
+        for vms in self._iter_vmpool():
+            self._prefetch_templates_and_networks(vms)
 
-                if isinstance(vm_template["NIC"], dict):
-                    vm_nics.append(vm_template["NIC"])
-                elif isinstance(vm.TEMPLATE["NIC"], list):
-                    vm_nics = vm_template["NIC"]
+            for vm in vms:
+                if vm.TEMPLATE is None or not get_vm_nics(vm.TEMPLATE):
+                    display.v(f"VM {vm.NAME} doesn't have any NICs attached to it, skipping it.")
+                    continue
 
-                for nic in vm_nics:
-                    vm_dict["nic"].append(one_dict_to_lowercase(nic))
+                vm_rows.append(list(self._get_record_for_vm(vm)))
 
-                    network_domain_name = get_domain_name_for_network(self.server, nic["NETWORK_ID"])
+        return {"fields": list(VMRecord._fields), "need_template": self._need_template,
+                "need_user_attributes": self._need_user_attributes, "vms": vm_rows}
 
-                    if network_domain_name is not None:
-                        vm_dict["network_id_domain_map"][nic["NETWORK_ID"]] = network_domain_name
+    def _prefetch_templates_and_networks(self, vms):
+        if not vms:
+            return
 
-        if hasattr(vm, "USER_TEMPLATE"):
-            vm_dict["user_attributes"] = one_dict_to_lowercase(vm.USER_TEMPLATE)
+        vm_templates = [vm.TEMPLATE for vm in vms if vm.TEMPLATE is not None]
 
-        return vm_dict
+        # anything the pools didn't cover, e.g. when the user isn't allowed to list them, is resolved one by one
+        if self._need_template:
+            if self._template_names is None:
+                self._template_names = self._get_template_names() or {}
 
-    def _query(self):
-        return [self._get_dict_for_vm(vm) for vm in self._get_vmpool().VM]
+            template_ids = {int(vm_template["TEMPLATE_ID"]) for vm_template in vm_templates
+                            if "TEMPLATE_ID" in vm_template} - self._template_names.keys()
+            if template_ids:
+                self._template_names.update(self._map_concurrently(self._get_template_name, template_ids))
+
+        if self._vn_domains is None:
+            self._vn_domains = self._get_vn_domains() or {}
+
+        network_ids = {int(nic["NETWORK_ID"]) for vm_template in vm_templates
+                       for nic in get_vm_nics(vm_template)} - self._vn_domains.keys()
+        if network_ids:
+            self._vn_domains.update(self._map_concurrently(self._get_vn_domain, network_ids))
 
     def _get_hostname(self, vm):
         hostname_preference = self.get_option("one_hostname_preference")
@@ -179,7 +386,7 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 f"Invalid value for option one_hostname_preference: {hostname_preference}")
 
         if hostname_preference == "fqdn":
-            domain = get_domain_name_for_network(self.server, vm["nic"][0]["network_id"])
+            domain = vm["network_id_domain_map"].get(vm["nic"][0]["network_id"])
 
             if domain is not None:
                 return to_text(vm["name"] + "." + domain)
@@ -190,29 +397,43 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             return vm["name"]
 
     def _populate_from_source(self, source_data):
-        for host in source_data:
-            if not len(host["nic"]):
-                display.v(
-                   f"VM {host['name']} doesn't have any NICs attached to it, skipping it.")
-                continue
-
-            hostname = self._get_hostname(host)
-
-            self.inventory.add_host(hostname)
-
-            for fact, value in host.items():
-                self.inventory.set_variable(hostname, fact, value)
+        strict = self.get_option('strict')
+        compose = self.get_option('compose')
+        groups = self.get_option('groups')
+        keyed_groups = self.get_option('keyed_groups')
+
+        # bound methods are looked up once, the loop below runs for every VM in the pool
+        add_host = self.inventory.add_host
+        get_host = self.inventory.get_host
+        set_variable = self.inventory.set_variable
+        get_hostname = self._get_hostname
+        set_composite_vars = self._set_composite_vars
+        add_host_to_composed_groups = self._add_host_to_composed_groups
+        add_host_to_keyed_groups = self._add_host_to_keyed_groups
+
+        for vm_record in source_data:
+            host = vm_record.as_dict()
+            hostname = get_hostname(host)
+
+            add_host(hostname)
+
+            host_vars = get_host(hostname).vars
+            if host_vars.keys().isdisjoint(host):
+                host_vars.update(host)
+            else:
+                # VM names aren't unique, keep set_variable's merging of facts for VMs sharing a hostname
+                for fact, value in host.items():
+                    set_variable(hostname, fact, value)
 
-            strict = self.get_option('strict')
-            self._set_composite_vars(self.get_option('compose'), host, hostname, strict=strict)
-            self._add_host_to_composed_groups(self.get_option('groups'), host, hostname, strict=strict)
-            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), host, hostname, strict=strict)
+            set_composite_vars(compose, host, hostname, strict=strict)
+            add_host_to_composed_groups(groups, host, hostname, strict=strict)
+            add_host_to_keyed_groups(keyed_groups, host, hostname, strict=strict)
 
     def verify_file(self, path):
-        if super(InventoryModule, self).verify_file(path):
-            if path.endswith(("one.yaml", "one.yml")):
-                return True
-        return False
+        # the suffix check is much cheaper than the base class' filesystem checks, so reject on it first
+        if not path.endswith(self._VALID_SUFFIXES):
+            return False
+        return super(InventoryModule, self).verify_file(path)
 
     def parse(self, inventory, loader, path, cache=True):
         if not HAS_PYONE_MODULE:
@@ -220,10 +441,33 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
         super(InventoryModule, self).parse(inventory, loader, path)
 
+        self._template_names = None
+        self._vn_domains = None
+
         config = self._read_config_data(path)
 
+        if self.get_option("one_concurrency") < 1:
+            raise AnsibleOptionsError(
+                f"Invalid value for option one_concurrency: {self.get_option('one_concurrency')}, it must be at least 1")
+
+        self._need_template = True
+        self._need_user_attributes = True
+
+        if self.get_option("one_skip_unused_facts"):
+            constructed_options = [self.get_option(option) for option in ("compose", "groups", "keyed_groups")]
+            self._need_template = any("template" in str(option) for option in constructed_options if option)
+            self._need_user_attributes = any("user_attributes" in str(option)
+                                             for option in constructed_options if option)
+
         self.server = pyone.OneServer(self.get_option("one_url"),
                                       self.get_option("one_username") + ":" + self.get_option("one_password"))
+        # pyone's own XML-RPC transport opens a new connection for every call, swap in a pooled keep-alive one.
+        # Newer pyone versions may return a gRPC client instead, which manages its own connections.
+        use_session_transport = isinstance(self.server, xmlrpc.client.ServerProxy)
+        if use_session_transport:
+            # one connection more than the workers, for the VM pool page fetched in the background
+            self.server._ServerProxy__transport = SessionTransport(self.get_option("one_url").startswith("https"),
+                                                                   pool_size=self.get_option("one_concurrency") + 1)
 
         cache_key = self.get_cache_key(path)
         source_data = None
@@ -237,11 +481,30 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 source_data = self._cache[cache_key]
             except KeyError:
                 cache_needs_update = True
+            else:
+                if isinstance(source_data, dict) and "blob" in source_data:
+                    source_data = decompress_cache_data(source_data)
+
+                # caches written by older versions of the plugin hold a plain list of VMs or other fields,
+                # and rows gathered without facts that are needed now can't be reused either
+                if (not isinstance(source_data, dict)
+                        or source_data.get("fields") != list(VMRecord._fields)
+                        or source_data.get("need_template") != self._need_template
+                        or source_data.get("need_user_attributes") != self._need_user_attributes):
+                    source_data = None
+                    cache_needs_update = True
 
         if source_data is None:
-            source_data = self._query()
+            try:
+                source_data = self._query()
+            finally:
+                if use_session_transport:
+                    self.server("close")()
 
         if cache_needs_update:
-            self._cache[cache_key] = source_data
+            if self.get_option("one_cache_compress"):
+                self._cache[cache_key] = compress_cache_data(source_data)
+            else:
+                self._cache[cache_key] = source_data
 
-        self._populate_from_source(source_data)
+        self._populate_from_source([VMRecord(*vm_row) for vm_row in source_data["vms"]])